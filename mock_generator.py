@@ -1,8 +1,18 @@
 import time
 import uuid
 import random
-from typing import Dict, Any, List
+import functools
+from typing import Dict, Any, List, Callable, AsyncIterator, Optional
 from dataclasses import dataclass
+import numpy as np
+import orjson
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TIKTOKEN_AVAILABLE = tiktoken is not None
 
 @dataclass
 class MockResponseConfig:
@@ -12,26 +22,155 @@ class MockResponseConfig:
     avg_output_tokens: int = 150
     model_name: str = "gpt-3.5-turbo"
     include_usage: bool = True
+    use_tiktoken: bool = False  # Count input tokens with tiktoken when installed
+
+@dataclass(slots=True)
+class StreamChunkEvent:
+    """A single chat.completion.chunk event of a streaming response"""
+    id: str
+    created: int
+    model: str
+    delta: Dict[str, str]
+    finish_reason: Optional[str] = None
+    usage: Optional[Dict[str, int]] = None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert to the OpenAI wire format"""
+        event = {
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "delta": self.delta,
+                "finish_reason": self.finish_reason
+            }]
+        }
+        if self.usage is not None:
+            event["usage"] = self.usage
+        return event
+        
+    def to_bytes(self) -> bytes:
+        """Serialize to JSON bytes with orjson, ready for the SSE transport"""
+        return orjson.dumps(self.to_dict())
+
+_ENCODER = None
+
+def _get_encoder():
+    """Get the shared tiktoken encoder, constructing it once per process"""
+    global _ENCODER
+    if _ENCODER is None:
+        _ENCODER = tiktoken.get_encoding("cl100k_base")
+    return _ENCODER
+
+RESPONSE_TEMPLATES = [
+    "I understand you're asking about: {topic}. Let me provide a comprehensive response...",
+    "Based on your question regarding {topic}, here's my analysis...",
+    "Regarding {topic}, I can share the following insights...",
+    "Let me help you with your question about {topic}..."
+]
+
+# Filler sentences paired with their precomputed word counts
+FILLER_SENTENCES = [
+    (sentence, sentence.count(" ") + 1)
+    for sentence in [
+        "This is an important consideration in modern applications.",
+        "The implications are significant for system design.",
+        "Multiple factors should be taken into account.",
+        "This approach offers several advantages.",
+        "Let me elaborate on this point further.",
+        "The technical details are quite fascinating.",
+        "This represents a common challenge in the field.",
+        "Understanding these concepts is crucial for success."
+    ]
+]
+
+@functools.lru_cache(maxsize=1024)
+def _build_response_content(template: str, topic: str, target_words: int) -> str:
+    """Build response text from a template, padded with filler to target_words"""
+    base_response = template.format(topic=topic)
+    
+    # Add filler content to reach target length
+    current_words = len(base_response.split())
+    remaining_words = max(0, target_words - current_words)
+    
+    filler_content = []
+    filler_words = 0
+    while filler_words < remaining_words:
+        sentence, word_count = random.choice(FILLER_SENTENCES)
+        filler_content.append(sentence)
+        filler_words += word_count
+        
+    full_response = base_response + " " + " ".join(filler_content)
+    
+    # Trim to approximate target
+    words = full_response.split()
+    if len(words) > target_words:
+        words = words[:target_words]
+        
+    return " ".join(words)
+
+class _SamplePool:
+    """Ring buffer of random samples drawn in bulk and refilled when exhausted"""
+    
+    def __init__(self, draw: Callable[[int], np.ndarray], size: int = 4096):
+        self._draw = draw
+        self._size = size
+        self._samples = []
+        self._idx = 0
+        
+    def next(self) -> int:
+        if self._idx >= len(self._samples):
+            self._samples = self._draw(self._size).tolist()
+            self._idx = 0
+        value = self._samples[self._idx]
+        self._idx += 1
+        return value
 
 class MockOpenAIResponseGenerator:
     """Generates realistic mock OpenAI API responses"""
     
     def __init__(self, config: MockResponseConfig = None):
         self.config = config or MockResponseConfig()
+        self._rng = np.random.default_rng()
+        
+        # Use normal distribution around average for output token counts
+        mean = self.config.avg_output_tokens
+        std_dev = (self.config.max_output_tokens - self.config.min_output_tokens) // 6
+        self._output_tokens = _SamplePool(
+            lambda n: np.clip(
+                self._rng.normal(mean, std_dev, n),
+                self.config.min_output_tokens,
+                self.config.max_output_tokens
+            ).astype(np.int64)
+        )
+        self._template_indices = _SamplePool(
+            lambda n: self._rng.integers(0, len(RESPONSE_TEMPLATES), n)
+        )
+        self._chunk_counts = _SamplePool(lambda n: self._rng.integers(5, 11, n))
+        
+        # Build the tiktoken encoder upfront, since loading it may download
+        # the BPE file and should not happen inside a request
+        self._encoder = (
+            _get_encoder() if self.config.use_tiktoken and tiktoken is not None else None
+        )
         
     def generate_response(
         self,
-        request_data: Dict[str, Any],
+        request: Any,
         api_key: str,
-        request_id: str = None
+        request_id: str = None,
+        input_tokens: Optional[int] = None
     ) -> Dict[str, Any]:
         """
         Generate a mock OpenAI API response based on the request
         
         Args:
-            request_data: The incoming request data (OpenAI format)
+            request: The incoming chat completion request model (OpenAI format)
             api_key: The API key making the request
             request_id: Optional request ID, generates one if not provided
+            input_tokens: Input token count already estimated by the caller
             
         Returns:
             Mock OpenAI API response
@@ -39,13 +178,13 @@ class MockOpenAIResponseGenerator:
         request_id = request_id or f"mock_req_{uuid.uuid4().hex}"
         
         # Extract request parameters
-        model = request_data.get("model", self.config.model_name)
-        messages = request_data.get("messages", [])
-        max_tokens = request_data.get("max_tokens", 150)
-        temperature = request_data.get("temperature", 0.7)
+        model = request.model or self.config.model_name
+        messages = request.messages
+        max_tokens = request.max_tokens or 150
         
-        # Calculate input tokens (rough estimation)
-        input_tokens = self._estimate_tokens(messages)
+        # Calculate input tokens unless the caller already did
+        if input_tokens is None:
+            input_tokens = self.estimate_tokens(messages)
         
         # Generate output tokens based on request
         output_tokens = min(
@@ -84,27 +223,29 @@ class MockOpenAIResponseGenerator:
         
         return response
         
-    def generate_streaming_response(
+    async def generate_streaming_response(
         self,
-        request_data: Dict[str, Any],
+        request: Any,
         api_key: str,
-        request_id: str = None
-    ) -> List[Dict[str, Any]]:
+        request_id: str = None,
+        input_tokens: Optional[int] = None
+    ) -> AsyncIterator[StreamChunkEvent]:
         """
         Generate mock streaming OpenAI API response
         
-        Returns:
-            List of SSE events for streaming response
+        Yields:
+            SSE events for streaming response, produced as they are consumed
         """
         request_id = request_id or f"mock_req_{uuid.uuid4().hex}"
         
         # Extract parameters
-        model = request_data.get("model", self.config.model_name)
-        messages = request_data.get("messages", [])
-        max_tokens = request_data.get("max_tokens", 150)
+        model = request.model or self.config.model_name
+        messages = request.messages
+        max_tokens = request.max_tokens or 150
         
-        # Calculate tokens
-        input_tokens = self._estimate_tokens(messages)
+        # Calculate tokens, reusing the caller's input estimate if given
+        if input_tokens is None:
+            input_tokens = self.estimate_tokens(messages)
         output_tokens = min(max_tokens, self._generate_output_tokens())
         
         # Generate response content
@@ -113,148 +254,101 @@ class MockOpenAIResponseGenerator:
         # Split content into chunks for streaming
         chunks = self._split_into_chunks(response_content, output_tokens)
         
-        # Build streaming events
-        events = []
+        # All events share one creation timestamp
+        created = int(time.time())
         
         # Initial response
-        events.append({
-            "id": request_id,
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [{
-                "index": 0,
-                "delta": {"role": "assistant"},
-                "finish_reason": None
-            }]
-        })
+        yield StreamChunkEvent(request_id, created, model, {"role": "assistant"})
         
         # Content chunks
         for chunk in chunks:
-            events.append({
-                "id": request_id,
-                "object": "chat.completion.chunk", 
-                "created": int(time.time()),
-                "model": model,
-                "choices": [{
-                    "index": 0,
-                    "delta": {"content": chunk},
-                    "finish_reason": None
-                }]
-            })
+            yield StreamChunkEvent(request_id, created, model, {"content": chunk})
         
         # Final response with usage
-        events.append({
-            "id": request_id,
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [{
-                "index": 0,
-                "delta": {},
-                "finish_reason": "stop"
-            }],
-            "usage": {
+        yield StreamChunkEvent(
+            request_id, created, model, {},
+            finish_reason="stop",
+            usage={
                 "prompt_tokens": input_tokens,
                 "completion_tokens": output_tokens,
                 "total_tokens": input_tokens + output_tokens
             }
-        })
+        )
         
-        return events
+    def estimate_tokens(self, messages: List[Any]) -> int:
+        """
+        Token estimation for messages, exact when the tiktoken backend is enabled.
+        Shared with the server so reported prompt_tokens match the charged tokens.
+        """
+        texts = list(self._iter_message_texts(messages))
         
-    def _estimate_tokens(self, messages: List[Dict[str, str]]) -> int:
-        """Rough token estimation for messages"""
-        total_chars = 0
+        if self._encoder is not None:
+            # Encode one text at a time; encode_ordinary_batch spins up a
+            # thread pool on every call
+            return sum(len(self._encoder.encode_ordinary(text)) for text in texts) or 1
+        
+        # Rough approximation: 1 token ≈ 3 characters (closer to BPE for English)
+        return sum(map(len, texts)) // 3 or 1
+        
+    @staticmethod
+    def _iter_message_texts(messages: List[Any]):
+        """Yield the text parts of each message's content"""
         for message in messages:
-            content = message.get("content", "")
+            content = message.content
             if isinstance(content, str):
-                total_chars += len(content)
+                yield content
             elif isinstance(content, list):
                 for item in content:
                     if isinstance(item, dict) and "text" in item:
-                        total_chars += len(item["text"])
-        
-        # Rough approximation: 1 token ≈ 4 characters
-        return max(1, total_chars // 4)
+                        yield item["text"]
         
     def _generate_output_tokens(self) -> int:
         """Generate realistic output token count"""
-        # Use normal distribution around average
-        mean = self.config.avg_output_tokens
-        std_dev = (self.config.max_output_tokens - self.config.min_output_tokens) // 6
-        
-        tokens = int(random.gauss(mean, std_dev))
-        return max(
-            self.config.min_output_tokens,
-            min(self.config.max_output_tokens, tokens)
-        )
+        return self._output_tokens.next()
         
-    def _generate_response_content(self, messages: List[Dict], target_tokens: int) -> str:
+    def _generate_response_content(self, messages: List[Any], target_tokens: int) -> str:
         """Generate mock response content"""
         if not messages:
             return "Hello! I'm a mock AI assistant. How can I help you today?"
             
         # Get the last user message
         last_message = messages[-1]
-        user_content = last_message.get("content", "")
+        user_content = last_message.content
         
         # Generate response based on message length and target tokens
         words_per_token = 0.75  # Rough approximation
         target_words = int(target_tokens * words_per_token)
         
-        # Create mock response
-        response_templates = [
-            "I understand you're asking about: {topic}. Let me provide a comprehensive response...",
-            "Based on your question regarding {topic}, here's my analysis...",
-            "Regarding {topic}, I can share the following insights...",
-            "Let me help you with your question about {topic}..."
-        ]
-        
-        template = random.choice(response_templates)
+        # Create mock response. Bucketing the target length down to a
+        # multiple of 10 words lets repeated prompts hit the content cache
+        # without exceeding the reported completion tokens.
+        template = RESPONSE_TEMPLATES[self._template_indices.next()]
         topic = user_content[:50] + "..." if len(user_content) > 50 else user_content
         
-        base_response = template.format(topic=topic)
-        
-        # Add filler content to reach target length
-        filler_sentences = [
-            "This is an important consideration in modern applications.",
-            "The implications are significant for system design.",
-            "Multiple factors should be taken into account.",
-            "This approach offers several advantages.",
-            "Let me elaborate on this point further.",
-            "The technical details are quite fascinating.",
-            "This represents a common challenge in the field.",
-            "Understanding these concepts is crucial for success."
-        ]
-        
-        current_words = len(base_response.split())
-        remaining_words = max(0, target_words - current_words)
-        
-        filler_content = []
-        while len(" ".join(filler_content).split()) < remaining_words:
-            filler_content.append(random.choice(filler_sentences))
-            
-        full_response = base_response + " " + " ".join(filler_content)
-        
-        # Trim to approximate target
-        words = full_response.split()
-        if len(words) > target_words:
-            words = words[:target_words]
-            
-        return " ".join(words)
+        return _build_response_content(template, topic, target_words - target_words % 10 or target_words)
         
     def _split_into_chunks(self, content: str, total_tokens: int) -> List[str]:
-        """Split content into chunks for streaming"""
-        words = content.split()
-        chunks = []
-        
+        """Split content into chunks for streaming by slicing at word boundaries"""
+        if not content:
+            return []
+            
         # Create 5-10 chunks
-        num_chunks = min(random.randint(5, 10), len(words))
-        words_per_chunk = max(1, len(words) // num_chunks)
+        word_count = content.count(" ") + 1
+        num_chunks = min(self._chunk_counts.next(), word_count)
+        words_per_chunk = max(1, word_count // num_chunks)
         
-        for i in range(0, len(words), words_per_chunk):
-            chunk_words = words[i:i + words_per_chunk]
-            chunks.append(" ".join(chunk_words))
+        # Each chunk ends at the space before its next word; the leading space
+        # stays with the following chunk so the chunks concatenate losslessly
+        chunks = []
+        start = 0
+        while start < len(content):
+            end = start
+            for _ in range(words_per_chunk):
+                end = content.find(" ", end + 1)
+                if end == -1:
+                    end = len(content)
+                    break
+            chunks.append(content[start:end])
+            start = end
             
-        return [chunk for chunk in chunks if chunk.strip()]
\ No newline at end of file
+        return chunks
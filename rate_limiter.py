@@ -1,9 +1,12 @@
 import asyncio
 import time
 import redis.asyncio as redis
-from typing import Dict, Tuple, Optional
+from redis.exceptions import NoScriptError
+from typing import Dict, List, Tuple, Optional
 import json
 import hashlib
+import xxhash
+import functools
 from dataclasses import dataclass
 import logging
 
@@ -14,9 +17,115 @@ try:
 except ImportError:
     MockRedisAsync = None
 
-@dataclass
+# Token sorted set members encode seq * TOKEN_MEMBER_BASE + tokens
+TOKEN_MEMBER_BASE = 1_000_000
+
+# Upper bound on requests per script call. The script runs atomically and
+# scans every key's sets, so large batches block other Redis clients.
+MAX_BATCH_SIZE = 32
+
+# Lua script for the atomic sliding window check, loaded once via SCRIPT LOAD.
+# One call checks a batch of requests in order, so requests for the same key
+# see each other's writes.
+RATE_LIMIT_SCRIPT = """
+-- Keys: per request [input_key, output_key, request_key, sequence_key]
+-- Args: [current_time, window_start,
+--        per request input_tokens, output_tokens, input_tpm, output_tpm, rpm]
+-- Returns: flat list of (allowed, message) pairs, one per request
+
+local current_time = tonumber(ARGV[1])
+local window_start = tonumber(ARGV[2])
+
+-- Token sets hold one integer member per request: seq * 1000000 + tokens.
+-- Larger token counts are rejected so they cannot spill into the seq digits.
+local function sum_tokens(key)
+    local total = 0
+    for _, member in ipairs(redis.call('ZRANGE', key, 0, -1)) do
+        total = total + tonumber(member) % 1000000
+    end
+    return total
+end
+
+-- Members are only unique while the sequence keeps counting up. If the
+-- sequence key was evicted (e.g. under allkeys-lru) while the sets survived,
+-- restart it after the highest sequence number still stored.
+local function seed_sequence(sequence_key, input_key, output_key, request_key)
+    if redis.call('EXISTS', sequence_key) == 1 then
+        return
+    end
+    local highest = 0
+    for _, member in ipairs(redis.call('ZRANGE', request_key, 0, -1)) do
+        highest = math.max(highest, tonumber(member))
+    end
+    for _, key in ipairs({input_key, output_key}) do
+        for _, member in ipairs(redis.call('ZRANGE', key, 0, -1)) do
+            highest = math.max(highest, math.floor(tonumber(member) / 1000000))
+        end
+    end
+    redis.call('SET', sequence_key, string.format('%d', highest))
+end
+
+local function check(input_key, output_key, request_key, sequence_key,
+                     input_tokens, output_tokens, input_tpm, output_tpm, rpm)
+    -- Remove old entries outside window
+    redis.call('ZREMRANGEBYSCORE', input_key, '-inf', window_start)
+    redis.call('ZREMRANGEBYSCORE', output_key, '-inf', window_start)
+    redis.call('ZREMRANGEBYSCORE', request_key, '-inf', window_start)
+
+    -- Token counts must fit below the sequence digits of a member
+    if input_tokens >= 1000000 or output_tokens >= 1000000 then
+        return 0, "Token count too large"
+    end
+
+    -- Check if request would exceed limits
+    if sum_tokens(input_key) + input_tokens > input_tpm then
+        return 0, "Input TPM limit exceeded"
+    end
+
+    if sum_tokens(output_key) + output_tokens > output_tpm then
+        return 0, "Output TPM limit exceeded"
+    end
+
+    if redis.call('ZCARD', request_key) + 1 > rpm then
+        return 0, "RPM limit exceeded"
+    end
+
+    -- Add a single integer entry per request with current timestamp as score.
+    -- The sequence wraps well before members lose double precision.
+    seed_sequence(sequence_key, input_key, output_key, request_key)
+    local seq = redis.call('INCR', sequence_key) % 1000000000
+    redis.call('ZADD', input_key, current_time, string.format('%d', seq * 1000000 + input_tokens))
+    redis.call('ZADD', output_key, current_time, string.format('%d', seq * 1000000 + output_tokens))
+    redis.call('ZADD', request_key, current_time, seq)
+
+    -- Set expiration to prevent memory leaks
+    redis.call('EXPIRE', input_key, 3600)
+    redis.call('EXPIRE', output_key, 3600)
+    redis.call('EXPIRE', request_key, 3600)
+    redis.call('EXPIRE', sequence_key, 3600)
+
+    return 1, "OK"
+end
+
+local results = {}
+for i = 0, #KEYS / 4 - 1 do
+    local k = i * 4
+    local a = 2 + i * 5
+    local allowed, message = check(
+        KEYS[k + 1], KEYS[k + 2], KEYS[k + 3], KEYS[k + 4],
+        tonumber(ARGV[a + 1]), tonumber(ARGV[a + 2]),
+        tonumber(ARGV[a + 3]), tonumber(ARGV[a + 4]), tonumber(ARGV[a + 5])
+    )
+    results[#results + 1] = allowed
+    results[#results + 1] = message
+end
+
+return results
+"""
+
+@dataclass(frozen=True)
 class RateLimitConfig:
-    """Rate limit configuration for an API key"""
+    """Rate limit configuration for an API key (shared via cache, immutable)"""
     input_tpm: int  # Input tokens per minute
     output_tpm: int  # Output tokens per minute  
     rpm: int        # Requests per minute
@@ -25,6 +134,10 @@ class DistributedRateLimiter:
     """
     Distributed rate limiter using Redis with sliding window algorithm.
     Uses Redis sorted sets for efficient sliding window tracking.
+    
+    Requires a single-node Redis (or a primary with replicas), not Redis
+    Cluster: one batched script call touches the keys of many API keys,
+    which Cluster rejects with CROSSSLOT.
     """
     
     def __init__(self, redis_url: str = "redis://localhost:6379", use_mock: bool = False):
@@ -32,12 +145,29 @@ class DistributedRateLimiter:
             self.redis = MockRedisAsync()
             self.is_mock = True
         else:
-            self.redis = redis.from_url(redis_url, decode_responses=False)
+            # Replies are small status strings and integer members, so let
+            # the client decode them; keep-alive connections are pooled.
+            # The blocking pool makes callers wait for a free connection
+            # when all are in use instead of failing with "Too many connections"
+            pool = redis.BlockingConnectionPool.from_url(
+                redis_url,
+                max_connections=100,
+                timeout=5,
+                decode_responses=True,
+                socket_keepalive=True
+            )
+            self.redis = redis.Redis(connection_pool=pool)
             self.is_mock = False
         self.window_size = 60  # 60 seconds sliding window
+        self._script_sha = hashlib.sha1(RATE_LIMIT_SCRIPT.encode()).hexdigest()
         
     async def initialize(self):
-        """Initialize Redis connection with retry"""
+        """Initialize Redis connection with retry and load the Lua script"""
+        await self._connect()
+        self._script_sha = await self.redis.script_load(RATE_LIMIT_SCRIPT)
+        
+    async def _connect(self):
+        """Connect to Redis with retry, falling back to mock Redis"""
         if self.is_mock:
             await self.redis.ping()
             return
@@ -62,18 +192,24 @@ class DistributedRateLimiter:
         """Close Redis connection"""
         await self.redis.close()
         
-    def _get_keys(self, api_key: str) -> Tuple[str, str, str]:
+    def _get_keys(self, api_key: str) -> Tuple[str, str, str, str]:
         """Generate Redis keys for different rate limit metrics"""
         base_key = f"rate_limit:{api_key}"
         return (
             f"{base_key}:input_tokens",
             f"{base_key}:output_tokens", 
-            f"{base_key}:requests"
+            f"{base_key}:requests",
+            f"{base_key}:sequence"
         )
         
     def _get_current_timestamp(self) -> int:
-        """Get current timestamp in seconds"""
-        return int(time.time())
+        """Get current timestamp in whole seconds, using integer math only"""
+        return time.time_ns() // 1_000_000_000
+        
+    @staticmethod
+    def _sum_tokens(members) -> int:
+        """Sum token counts encoded in sorted set members as seq * 1000000 + tokens"""
+        return sum(int(member) % TOKEN_MEMBER_BASE for member in members)
         
     async def check_rate_limit(
         self, 
@@ -92,108 +228,86 @@ class DistributedRateLimiter:
         Returns:
             Tuple of (is_allowed, error_message)
         """
-        if not api_key:
-            return False, "Missing API key"
+        results = await self.check_rate_limit_batch([(api_key, input_tokens, output_tokens)])
+        return results[0]
+        
+    async def check_rate_limit_batch(
+        self,
+        requests: List[Tuple[str, int, int]]
+    ) -> List[Tuple[bool, Optional[str]]]:
+        """
+        Check a batch of requests with a single Lua script call.
+        
+        Args:
+            requests: (api_key, input_tokens, output_tokens) per request,
+                at most MAX_BATCH_SIZE of them
+            
+        Returns:
+            (is_allowed, error_message) per request, in the same order
+        """
+        results: List[Tuple[bool, Optional[str]]] = [None] * len(requests)
+        keys = []
+        token_args = []
+        pending = []
+        
+        for index, (api_key, input_tokens, output_tokens) in enumerate(requests):
+            if not api_key:
+                results[index] = (False, "Missing API key")
+                continue
+                
+            # Get rate limits for this API key
+            config = self._get_rate_limit_config(api_key)
+            if not config:
+                results[index] = (False, "Invalid API key")
+                continue
+                
+            keys.extend(self._get_keys(api_key))
+            token_args.extend((
+                input_tokens, output_tokens,
+                config.input_tpm, config.output_tpm, config.rpm
+            ))
+            pending.append(index)
             
-        # Get rate limits for this API key
-        config = await self._get_rate_limit_config(api_key)
-        if not config:
-            return False, "Invalid API key"
+        if not pending:
+            return results
             
-        input_key, output_key, request_key = self._get_keys(api_key)
         current_time = self._get_current_timestamp()
         window_start = current_time - self.window_size
         
         # Use Redis Lua script for atomicity
-        lua_script = """
-        -- Keys: [input_key, output_key, request_key]
-        -- Args: [current_time, window_start, input_tokens, output_tokens, 1, 
-        --        input_tpm, output_tpm, rpm]
-        
-        local input_key = KEYS[1]
-        local output_key = KEYS[2] 
-        local request_key = KEYS[3]
-        
-        local current_time = tonumber(ARGV[1])
-        local window_start = tonumber(ARGV[2])
-        local input_tokens = tonumber(ARGV[3])
-        local output_tokens = tonumber(ARGV[4])
-        local request_count = tonumber(ARGV[5])
-        local input_tpm = tonumber(ARGV[6])
-        local output_tpm = tonumber(ARGV[7])
-        local rpm = tonumber(ARGV[8])
-        
-        -- Remove old entries outside window
-        redis.call('ZREMRANGEBYSCORE', input_key, '-inf', window_start)
-        redis.call('ZREMRANGEBYSCORE', output_key, '-inf', window_start)
-        redis.call('ZREMRANGEBYSCORE', request_key, '-inf', window_start)
-        
-        -- Calculate current usage
-        local current_input = redis.call('ZCARD', input_key)
-        local current_output = redis.call('ZCARD', output_key)  
-        local current_requests = redis.call('ZCARD', request_key)
-        
-        -- Check if request would exceed limits
-        if current_input + input_tokens > input_tpm then
-            return {0, "Input TPM limit exceeded"}
-        end
-        
-        if current_output + output_tokens > output_tpm then
-            return {0, "Output TPM limit exceeded"}
-        end
-        
-        if current_requests + request_count > rpm then
-            return {0, "RPM limit exceeded"}
-        end
-        
-        -- Add new entries with current timestamp as score
-        for i = 1, input_tokens do
-            redis.call('ZADD', input_key, current_time, current_time .. ":" .. math.random())
-        end
-        
-        for i = 1, output_tokens do
-            redis.call('ZADD', output_key, current_time, current_time .. ":" .. math.random())
-        end
-        
-        for i = 1, request_count do
-            redis.call('ZADD', request_key, current_time, current_time .. ":" .. math.random())
-        end
-        
-        -- Set expiration to prevent memory leaks
-        redis.call('EXPIRE', input_key, 3600)
-        redis.call('EXPIRE', output_key, 3600)
-        redis.call('EXPIRE', request_key, 3600)
-        
-        return {1, "OK"}
-        """
+        args = (*keys, current_time, window_start, *token_args)
         
         try:
-            result = await self.redis.eval(
-                lua_script, 3,  # 3 keys
-                input_key, output_key, request_key,
-                current_time, window_start, input_tokens, output_tokens, 1,
-                config.input_tpm, config.output_tpm, config.rpm
-            )
-            
-            allowed = bool(result[0])
-            message = result[1].decode() if isinstance(result[1], bytes) else str(result[1])
-            
-            return allowed, None if allowed else message
-            
+            try:
+                reply = await self.redis.evalsha(self._script_sha, len(keys), *args)
+            except NoScriptError:
+                # Script cache was flushed (e.g. Redis restart), reload and retry
+                self._script_sha = await self.redis.script_load(RATE_LIMIT_SCRIPT)
+                reply = await self.redis.evalsha(self._script_sha, len(keys), *args)
+                
+            for position, index in enumerate(pending):
+                allowed = bool(reply[2 * position])
+                results[index] = (allowed, None if allowed else reply[2 * position + 1])
+                
         except Exception as e:
-            return False, f"Rate limit check failed: {str(e)}"
+            for index in pending:
+                results[index] = (False, f"Rate limit check failed: {str(e)}")
+                
+        return results
             
-    async def _get_rate_limit_config(self, api_key: str) -> Optional[RateLimitConfig]:
-        """Get rate limit configuration for API key"""
+    @staticmethod
+    @functools.lru_cache(maxsize=100_000)
+    def _get_rate_limit_config(api_key: str) -> Optional[RateLimitConfig]:
+        """Get rate limit configuration for API key (memoized per key)"""
         # In production, this would come from a database
-        # For demo, use hash of API key to generate deterministic config
-        hash_obj = hashlib.md5(api_key.encode())
-        hash_hex = hash_obj.hexdigest()
+        # For demo, use a fast non-cryptographic hash of API key to generate
+        # deterministic config
+        hash_int = xxhash.xxh64_intdigest(api_key.encode())
         
         # Generate pseudo-random but deterministic rate limits
-        input_tpm = 10000 + (int(hash_hex[:4], 16) % 50000)  # 10K-60K
-        output_tpm = 5000 + (int(hash_hex[4:8], 16) % 25000)   # 5K-30K
-        rpm = 100 + (int(hash_hex[8:12], 16) % 900)            # 100-1000
+        input_tpm = 10000 + (((hash_int >> 48) & 0xFFFF) % 50000)  # 10K-60K
+        output_tpm = 5000 + (((hash_int >> 32) & 0xFFFF) % 25000)   # 5K-30K
+        rpm = 100 + (((hash_int >> 16) & 0xFFFF) % 900)             # 100-1000
         
         return RateLimitConfig(
             input_tpm=input_tpm,
@@ -203,24 +317,28 @@ class DistributedRateLimiter:
         
     async def get_usage_stats(self, api_key: str) -> Dict:
         """Get current usage statistics for an API key"""
-        input_key, output_key, request_key = self._get_keys(api_key)
-        current_time = self._get_current_timestamp()
-        window_start = current_time - self.window_size
+        input_key, output_key, request_key, _ = self._get_keys(api_key)
+        window_start = self._get_current_timestamp() - self.window_size
         
-        pipeline = self.redis.pipeline()
-        pipeline.zcount(input_key, window_start, current_time)
-        pipeline.zcount(output_key, window_start, current_time)
-        pipeline.zcount(request_key, window_start, current_time)
+        # Trim and read in a single MULTI/EXEC round trip. Nothing is
+        # conditionally written here, so native commands replace the Lua script.
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.zremrangebyscore(input_key, '-inf', window_start)
+        pipeline.zremrangebyscore(output_key, '-inf', window_start)
+        pipeline.zremrangebyscore(request_key, '-inf', window_start)
+        pipeline.zrange(input_key, 0, -1)
+        pipeline.zrange(output_key, 0, -1)
+        pipeline.zcard(request_key)
         
-        results = await pipeline.execute()
-        config = await self._get_rate_limit_config(api_key)
+        input_members, output_members, requests_used = (await pipeline.execute())[3:]
+        config = self._get_rate_limit_config(api_key)
         
         return {
-            "input_tokens_used": results[0],
+            "input_tokens_used": self._sum_tokens(input_members),
             "input_tokens_limit": config.input_tpm,
-            "output_tokens_used": results[1], 
+            "output_tokens_used": self._sum_tokens(output_members), 
             "output_tokens_limit": config.output_tpm,
-            "requests_used": results[2],
+            "requests_used": requests_used,
             "requests_limit": config.rpm,
             "window_size_seconds": self.window_size
         }
\ No newline at end of file
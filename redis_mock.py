@@ -1,40 +1,32 @@
 import asyncio
+import hashlib
+import itertools
 import time
-import uuid
-from collections import defaultdict, deque
+from collections import deque
 from typing import Dict, List, Tuple, Optional
-import threading
 
 class MockRedis:
     """In-memory mock Redis for testing without Redis server"""
     
     def __init__(self):
         self.data = {}
-        self.locks = defaultdict(threading.Lock)
         
     def zadd(self, key: str, *args):
         """Mock ZADD operation"""
         if key not in self.data:
-            self.data[key] = deque(maxlen=10000)
-            
+            self.data[key] = deque()
+        entries = self.data[key]
+        
         # Parse arguments: score1 member1 score2 member2 ...
-        args_list = list(args)
-        for i in range(0, len(args_list), 2):
-            if i + 1 < len(args_list):
-                score = args_list[i]
-                member = args_list[i + 1]
-                self.data[key].append((score, member))
-                
-        # Keep only recent entries (simulate sliding window)
-        current_time = time.time()
-        cutoff_time = current_time - 60
+        entries.extend(zip(args[0::2], args[1::2]))
         
-        self.data[key] = deque(
-            [(s, m) for s, m in self.data[key] if s >= cutoff_time],
-            maxlen=10000
-        )
+        # Keep only recent entries (simulate sliding window). Entries are
+        # appended in time order, so expired ones are always at the head.
+        cutoff_time = time.time() - 60
+        while entries and entries[0][0] < cutoff_time:
+            entries.popleft()
         
-        return len([x for x in args[1::2]])
+        return len(args) // 2
         
     def zremrangebyscore(self, key: str, min_score: str, max_score: str):
         """Mock ZREMRANGEBYSCORE operation"""
@@ -51,17 +43,24 @@ class MockRedis:
         else:
             max_score = float(max_score)
             
-        original_len = len(self.data[key])
+        entries = self.data[key]
+        original_len = len(entries)
+        
+        # Expired entries sit at the head of the time-ordered deque
+        if min_score == float('-inf'):
+            while entries and entries[0][0] <= max_score:
+                entries.popleft()
+            return original_len - len(entries)
+            
         self.data[key] = deque(
-            [(s, m) for s, m in self.data[key] if not (min_score <= s <= max_score)],
-            maxlen=10000
+            (s, m) for s, m in entries if not (min_score <= s <= max_score)
         )
         
         return original_len - len(self.data[key])
         
     def zcard(self, key: str):
         """Mock ZCARD operation"""
-        return len(self.data.get(key, deque()))
+        return len(self.data.get(key, ()))
         
     def zcount(self, key: str, min_score: str, max_score: str):
         """Mock ZCOUNT operation"""
@@ -80,12 +79,34 @@ class MockRedis:
             
         return len([s for s, _ in self.data[key] if min_score <= s <= max_score])
         
+    def zrange(self, key: str, start: int, end: int):
+        """Mock ZRANGE operation"""
+        members = [m for _, m in self.data.get(key, ())]
+        return members[start:None if end == -1 else end + 1]
+        
+    def zrangebyscore(self, key: str, min_score: str, max_score: str):
+        """Mock ZRANGEBYSCORE operation"""
+        if key not in self.data:
+            return []
+            
+        if min_score == '-inf':
+            min_score = float('-inf')
+        else:
+            min_score = float(min_score)
+            
+        if max_score == '+inf':
+            max_score = float('inf')
+        else:
+            max_score = float(max_score)
+            
+        return [m for s, m in self.data[key] if min_score <= s <= max_score]
+        
     def expire(self, key: str, seconds: int):
         """Mock EXPIRE operation"""
         return 1
         
-    def pipeline(self):
-        """Mock pipeline"""
+    def pipeline(self, transaction: bool = True):
+        """Mock pipeline, commands run immediately so it is always atomic"""
         return MockPipeline(self)
         
     async def ping(self):
@@ -110,6 +131,30 @@ class MockPipeline:
         self.results.append(result)
         return self
         
+    def zrangebyscore(self, key: str, min_score: str, max_score: str):
+        """Mock ZRANGEBYSCORE in pipeline"""
+        result = self.redis.zrangebyscore(key, min_score, max_score)
+        self.results.append(result)
+        return self
+        
+    def zremrangebyscore(self, key: str, min_score: str, max_score: str):
+        """Mock ZREMRANGEBYSCORE in pipeline"""
+        result = self.redis.zremrangebyscore(key, min_score, max_score)
+        self.results.append(result)
+        return self
+        
+    def zrange(self, key: str, start: int, end: int):
+        """Mock ZRANGE in pipeline"""
+        result = self.redis.zrange(key, start, end)
+        self.results.append(result)
+        return self
+        
+    def zcard(self, key: str):
+        """Mock ZCARD in pipeline"""
+        result = self.redis.zcard(key)
+        self.results.append(result)
+        return self
+        
     async def execute(self):
         """Execute pipeline"""
         return self.results
@@ -119,6 +164,7 @@ class MockRedisAsync:
     
     def __init__(self):
         self.mock = MockRedis()
+        self._sequence = itertools.count(1)
         
     async def ping(self):
         return self.mock.ping()
@@ -129,6 +175,9 @@ class MockRedisAsync:
     async def zcount(self, key: str, min_score: str, max_score: str):
         return self.mock.zcount(key, min_score, max_score)
         
+    async def zrangebyscore(self, key: str, min_score: str, max_score: str):
+        return self.mock.zrangebyscore(key, min_score, max_score)
+        
     async def zadd(self, key: str, *args):
         return self.mock.zadd(key, *args)
         
@@ -141,37 +190,68 @@ class MockRedisAsync:
     async def expire(self, key: str, seconds: int):
         return self.mock.expire(key, seconds)
         
-    def pipeline(self):
+    def pipeline(self, transaction: bool = True):
         return MockPipeline(self.mock)
         
     async def eval(self, script: str, numkeys: int, *args):
         """Mock EVAL for Lua scripts"""
         return await self._mock_eval(script, numkeys, *args)
         
+    async def script_load(self, script: str):
+        """Mock SCRIPT LOAD, returns the script's SHA1 like Redis"""
+        return hashlib.sha1(script.encode()).hexdigest()
+        
+    async def evalsha(self, sha: str, numkeys: int, *args):
+        """Mock EVALSHA, the rate limit script is emulated so any SHA runs it"""
+        return await self._mock_eval(sha, numkeys, *args)
+        
     async def _mock_eval(self, script: str, numkeys: int, *args):
-        """Mock Lua script execution"""
+        """Mock Lua script execution, returns (allowed, message) pairs"""
         keys = args[:numkeys]
         argv = args[numkeys:]
         
         # Simplified implementation of the rate limiting logic
-        current_time = float(argv[0])
-        window_start = float(argv[1])
-        input_tokens = int(argv[2])
-        output_tokens = int(argv[3])
-        request_count = int(argv[4])
-        input_tpm = int(argv[5])
-        output_tpm = int(argv[6])
-        rpm = int(argv[7])
+        current_time = int(argv[0])
+        window_start = int(argv[1])
+        
+        results = []
+        for i in range(numkeys // 4):
+            input_tokens, output_tokens, input_tpm, output_tpm, rpm = (
+                int(arg) for arg in argv[2 + i * 5:7 + i * 5]
+            )
+            input_key, output_key, request_key, _ = keys[i * 4:i * 4 + 4]
+            results.extend(await self._mock_check(
+                current_time, window_start, input_key, output_key, request_key,
+                input_tokens, output_tokens, input_tpm, output_tpm, rpm
+            ))
+            
+        return results
         
+    async def _mock_check(
+        self, current_time: int, window_start: int,
+        input_key: str, output_key: str, request_key: str,
+        input_tokens: int, output_tokens: int,
+        input_tpm: int, output_tpm: int, rpm: int
+    ):
+        """Check and record a single request, mirroring the Lua script"""
         # Remove old entries
-        for key in keys:
+        for key in (input_key, output_key, request_key):
             await self.zremrangebyscore(key, '-inf', str(window_start))
             
-        # Check limits
-        input_key, output_key, request_key = keys
-        
-        current_input = await self.zcount(input_key, str(window_start), str(current_time))
-        current_output = await self.zcount(output_key, str(window_start), str(current_time))
+        # Token counts must fit below the sequence digits of a member
+        if input_tokens >= 1_000_000 or output_tokens >= 1_000_000:
+            return [0, "Token count too large"]
+            
+        # Check limits. Token sets hold one integer member per request,
+        # encoded as seq * 1000000 + tokens
+        current_input = sum(
+            int(m) % 1_000_000
+            for m in await self.zrangebyscore(input_key, str(window_start), str(current_time))
+        )
+        current_output = sum(
+            int(m) % 1_000_000
+            for m in await self.zrangebyscore(output_key, str(window_start), str(current_time))
+        )
         current_requests = await self.zcount(request_key, str(window_start), str(current_time))
         
         if current_input + input_tokens > input_tpm:
@@ -180,18 +260,13 @@ class MockRedisAsync:
         if current_output + output_tokens > output_tpm:
             return [0, "Output TPM limit exceeded"]
             
-        if current_requests + request_count > rpm:
+        if current_requests + 1 > rpm:
             return [0, "RPM limit exceeded"]
             
-        # Add new entries
-        for _ in range(input_tokens):
-            await self.zadd(input_key, current_time, f"{current_time}_{uuid.uuid4()}")
-            
-        for _ in range(output_tokens):
-            await self.zadd(output_key, current_time, f"{current_time}_{uuid.uuid4()}")
+        # Add a single entry per request
+        seq = next(self._sequence) % 1_000_000_000
+        await self.zadd(input_key, current_time, seq * 1_000_000 + input_tokens)
+        await self.zadd(output_key, current_time, seq * 1_000_000 + output_tokens)
+        await self.zadd(request_key, current_time, seq)
             
-        for _ in range(request_count):
-            await self.zadd(request_key, current_time, f"{current_time}_{uuid.uuid4()}")
-            
-        return [1, "OK"]
-
+        return [1, "OK"]
\ No newline at end of file
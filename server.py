@@ -1,18 +1,18 @@
 import asyncio
 import uvloop
 import time
-import json
-from typing import Dict, Any, Optional
-from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse, JSONResponse
-from pydantic import BaseModel, Field
+from typing import Optional, Annotated
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse
+import msgspec
+import orjson
 import logging
 import os
 import signal
 import sys
 
-from rate_limiter import DistributedRateLimiter
-from mock_generator import MockOpenAIResponseGenerator, MockResponseConfig
+from rate_limiter import DistributedRateLimiter, MAX_BATCH_SIZE
+from mock_generator import MockOpenAIResponseGenerator, MockResponseConfig, TIKTOKEN_AVAILABLE
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,39 +21,131 @@ logger = logging.getLogger(__name__)
 # Install uvloop for better async performance
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-# Request/Response models
-class ChatMessage(BaseModel):
+# Request/Response models, decoded and validated by msgspec
+class ChatMessage(msgspec.Struct):
     role: str
     content: str
 
-class ChatCompletionRequest(BaseModel):
-    model: str = Field(default="gpt-3.5-turbo")
+class ChatCompletionRequest(msgspec.Struct, kw_only=True):
+    model: str = "gpt-3.5-turbo"
     messages: list[ChatMessage]
-    max_tokens: Optional[int] = Field(default=150, ge=1, le=4096)
-    temperature: Optional[float] = Field(default=0.7, ge=0.0, le=2.0)
-    stream: Optional[bool] = Field(default=False)
+    max_tokens: Optional[Annotated[int, msgspec.Meta(ge=1, le=4096)]] = 150
+    temperature: Optional[Annotated[float, msgspec.Meta(ge=0.0, le=2.0)]] = 0.7
+    stream: Optional[bool] = False
 
 class RateLimitError(HTTPException):
     def __init__(self, detail: str, retry_after: int = 1):
         super().__init__(status_code=429, detail=detail)
         self.headers = {"Retry-After": str(retry_after)}
 
+class _RateLimitBatcher:
+    """
+    Coalesces concurrent rate limit checks into one Lua script call.
+    When no batch is in flight, queued checks go out on the next loop
+    iteration. While one is, new checks queue for at most max_delay seconds,
+    until the in-flight batch returns, or until max_batch_size requests are
+    waiting, before a single Redis round trip resolves them all.
+    """
+    
+    def __init__(self, rate_limiter: DistributedRateLimiter,
+                 max_delay: float = 0.001, max_batch_size: int = MAX_BATCH_SIZE):
+        self.rate_limiter = rate_limiter
+        self.max_delay = max_delay
+        self.max_batch_size = max_batch_size
+        self._pending: list = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._tasks: set = set()
+        
+    def check(self, api_key: str, input_tokens: int, output_tokens: int) -> asyncio.Future:
+        """Queue a rate limit check, the future resolves to (is_allowed, error_message)"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((api_key, input_tokens, output_tokens, future))
+        
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._schedule(loop)
+            
+        return future
+        
+    def _schedule(self, loop: asyncio.AbstractEventLoop):
+        """Schedule a flush, only holding checks back while Redis is busy"""
+        if self._tasks:
+            self._flush_handle = loop.call_later(self.max_delay, self._flush)
+        else:
+            self._flush_handle = loop.call_soon(self._flush)
+        
+    def _flush(self):
+        """Send the queued checks as one batch"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+            
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._batch_done)
+        
+    def _batch_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        # Redis is idle again, send the checks that queued up behind the batch
+        if self._pending and not self._tasks:
+            self._flush()
+        
+    async def _run_batch(self, batch: list):
+        try:
+            results = await self.rate_limiter.check_rate_limit_batch(
+                [(api_key, input_tokens, output_tokens) for api_key, input_tokens, output_tokens, _ in batch]
+            )
+        except Exception as e:
+            results = [(False, f"Rate limit check failed: {str(e)}")] * len(batch)
+            
+        for (*_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
 class LLMAPIServer:
-    def __init__(self, redis_url: str = "redis://localhost:6379", port: int = 8000):
+    def __init__(
+        self,
+        redis_url: str = "redis://localhost:6379",
+        port: int = 8000,
+        use_tiktoken: bool = False
+    ):
         self.app = FastAPI(
             title="Distributed LLM API Rate Limiter",
             description="High-performance distributed rate limiting for LLM APIs",
-            version="1.0.0"
+            version="1.0.0",
+            default_response_class=ORJSONResponse
         )
         self.port = port
+        if use_tiktoken and not TIKTOKEN_AVAILABLE:
+            logger.warning("tiktoken is not installed, estimating input tokens from characters")
         self.rate_limiter = DistributedRateLimiter(redis_url)
-        self.response_generator = MockOpenAIResponseGenerator()
+        self.response_generator = MockOpenAIResponseGenerator(
+            MockResponseConfig(use_tiktoken=use_tiktoken)
+        )
+        self.rate_limit_batcher: Optional[_RateLimitBatcher] = None
         self.request_count = 0
+        
+        # Static headers, built once (mock limit values); Starlette copies
+        # them into each response without mutating the dicts
+        self._base_headers = {
+            "X-RateLimit-InputTPM-Limit": "60000",
+            "X-RateLimit-OutputTPM-Limit": "30000",
+            "X-RateLimit-RPM-Limit": "1000"
+        }
+        self._stream_headers = {
+            **self._base_headers,
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive"
+        }
         self.setup_routes()
         
     async def initialize(self):
         """Initialize server components"""
         await self.rate_limiter.initialize()
+        self.rate_limit_batcher = _RateLimitBatcher(self.rate_limiter)
         logger.info(f"Server initialized on port {self.port}")
         
     async def cleanup(self):
@@ -110,45 +202,10 @@ class LLMAPIServer:
                 ]
             }
             
-        @self.app.post("/v1/chat/completions")
-        async def chat_completions(
-            request: ChatCompletionRequest,
-            background_tasks: BackgroundTasks,
-            raw_request: Request
-        ):
-            """Handle chat completions with rate limiting"""
-            
-            # Extract API key from Authorization header
-            auth_header = raw_request.headers.get("Authorization", "")
-            if not auth_header.startswith("Bearer "):
-                raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-                
-            api_key = auth_header[7:]  # Remove "Bearer " prefix
-            
-            # Estimate tokens
-            input_tokens = self._estimate_input_tokens(request.messages)
-            output_tokens = request.max_tokens or 150
-            
-            # Check rate limits
-            allowed, error_message = await self.rate_limiter.check_rate_limit(
-                api_key, input_tokens, output_tokens
-            )
-            
-            if not allowed:
-                logger.warning(f"Rate limit exceeded for API key: {api_key[:8]}... - {error_message}")
-                raise RateLimitError(error_message)
-                
-            # Generate mock response
-            request_dict = request.dict()
-            
-            if request.stream:
-                return await self._handle_streaming_response(
-                    request_dict, api_key
-                )
-            else:
-                return await self._handle_regular_response(
-                    request_dict, api_key
-                )
+        # Hot path: plain Starlette route, skipping FastAPI dependency injection
+        self.app.router.add_route(
+            "/v1/chat/completions", self._raw_chat_completions, methods=["POST"]
+        )
                 
         @self.app.get("/v1/usage/{api_key}")
         async def get_usage_stats(api_key: str):
@@ -159,59 +216,117 @@ class LLMAPIServer:
             except Exception as e:
                 raise HTTPException(status_code=500, detail=str(e))
                 
-    def _estimate_input_tokens(self, messages: list[ChatMessage]) -> int:
-        """Estimate input tokens from messages"""
-        total_chars = 0
-        for msg in messages:
-            total_chars += len(msg.content)
+    async def _raw_chat_completions(self, request: Request) -> Response:
+        """Handle chat completions with rate limiting"""
         
-        # Rough approximation: 1 token ≈ 4 characters
-        return max(1, total_chars // 4)
+        # Extract API key from Authorization header
+        auth_header = request.headers.get("Authorization", "")
+        if not auth_header.startswith("Bearer "):
+            raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
+            
+        api_key = auth_header[7:]  # Remove "Bearer " prefix
         
-    async def _handle_regular_response(self, request_dict: Dict, api_key: str) -> Dict[str, Any]:
+        # Decode and validate the body in one pass
+        try:
+            completion_request = msgspec.json.decode(
+                await request.body(), type=ChatCompletionRequest
+            )
+        except msgspec.DecodeError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+            
+        # Event pacing only applies to streaming responses
+        simulate_delay_ms = 0
+        if completion_request.stream:
+            simulate_delay_ms = self._parse_simulate_delay_ms(request)
+            
+        # Estimate tokens
+        input_tokens = self._estimate_input_tokens(completion_request.messages)
+        output_tokens = completion_request.max_tokens or 150
+        
+        # Check rate limits
+        allowed, error_message = await self.rate_limit_batcher.check(
+            api_key, input_tokens, output_tokens
+        )
+        
+        if not allowed:
+            logger.warning(f"Rate limit exceeded for API key: {api_key[:8]}... - {error_message}")
+            raise RateLimitError(error_message)
+            
+        # Generate mock response
+        if completion_request.stream:
+            return await self._handle_streaming_response(
+                completion_request, api_key, input_tokens, simulate_delay_ms
+            )
+        else:
+            return await self._handle_regular_response(
+                completion_request, api_key, input_tokens
+            )
+            
+    @staticmethod
+    def _parse_simulate_delay_ms(request: Request) -> int:
+        """Read the optional simulate_delay_ms query parameter"""
+        try:
+            simulate_delay_ms = int(request.query_params.get("simulate_delay_ms", 0))
+        except ValueError:
+            simulate_delay_ms = -1
+            
+        if simulate_delay_ms < 0:
+            raise HTTPException(status_code=422, detail="simulate_delay_ms must be a non-negative integer")
+        return simulate_delay_ms
+        
+    def _estimate_input_tokens(self, messages: list[ChatMessage]) -> int:
+        """Estimate input tokens with the generator's estimator, so the charged
+        tokens match the reported prompt_tokens"""
+        return self.response_generator.estimate_tokens(messages)
+        
+    async def _handle_regular_response(
+        self,
+        request: ChatCompletionRequest,
+        api_key: str,
+        input_tokens: int
+    ) -> Response:
         """Handle non-streaming response"""
         response = self.response_generator.generate_response(
-            request_dict, api_key
+            request, api_key, input_tokens=input_tokens
         )
         
         self.request_count += 1
         
-        # Add rate limit headers
-        return JSONResponse(
-            content=response,
-            headers={
-                "X-RateLimit-InputTPM-Limit": str(60000),  # Mock values
-                "X-RateLimit-OutputTPM-Limit": str(30000),
-                "X-RateLimit-RPM-Limit": str(1000),
-                "X-Request-ID": response["id"]
-            }
+        # Serialize once and add rate limit headers
+        return Response(
+            content=orjson.dumps(response),
+            media_type="application/json",
+            headers={**self._base_headers, "X-Request-ID": response["id"]}
         )
         
-    async def _handle_streaming_response(self, request_dict: Dict, api_key: str):
-        """Handle streaming response"""
+    async def _handle_streaming_response(
+        self,
+        request: ChatCompletionRequest,
+        api_key: str,
+        input_tokens: int,
+        simulate_delay_ms: int = 0
+    ):
+        """Handle streaming response, optionally pacing events for demos"""
         events = self.response_generator.generate_streaming_response(
-            request_dict, api_key
+            request, api_key, input_tokens=input_tokens
         )
         
         self.request_count += 1
         
+        delay = simulate_delay_ms / 1000
+        
         async def generate():
-            for event in events:
-                yield f"data: {json.dumps(event)}\n\n"
-                await asyncio.sleep(0.01)  # Simulate streaming delay
+            async for event in events:
+                yield b"data: " + event.to_bytes() + b"\n\n"
+                if delay:
+                    await asyncio.sleep(delay)  # Simulate streaming delay
                 
-            yield "data: [DONE]\n\n"
+            yield b"data: [DONE]\n\n"
             
         return StreamingResponse(
             generate(),
-            media_type="text/plain",
-            headers={
-                "X-RateLimit-InputTPM-Limit": str(60000),
-                "X-RateLimit-OutputTPM-Limit": str(30000), 
-                "X-RateLimit-RPM-Limit": str(1000),
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive"
-            }
+            media_type="text/event-stream",
+            headers=self._stream_headers
         )
         
     def run(self, host: str = "0.0.0.0", workers: int = 1):
@@ -223,8 +338,10 @@ class LLMAPIServer:
             host=host,
             port=self.port,
             workers=workers,
+            loop="uvloop",
+            http="httptools",
             log_level="info",
-            access_log=True
+            access_log=False
         )
 
 if __name__ == "__main__":
@@ -234,8 +351,10 @@ if __name__ == "__main__":
     parser.add_argument("--port", type=int, default=8000, help="Port to run on")
     parser.add_argument("--redis", default="redis://localhost:6379", help="Redis URL")
     parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--tiktoken", action="store_true",
+                        help="Count input tokens with tiktoken (requires tiktoken)")
     
     args = parser.parse_args()
     
-    server = LLMAPIServer(redis_url=args.redis, port=args.port)
+    server = LLMAPIServer(redis_url=args.redis, port=args.port, use_tiktoken=args.tiktoken)
     server.run(workers=args.workers)
\ No newline at end of file
@@ -1,23 +1,28 @@
 import asyncio
+import uvloop
 import aiohttp
 import time
 import json
-import random
 import logging
 import os
 import sys
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Tuple
 from dataclasses import dataclass
-from collections import defaultdict, deque
-import statistics
+from collections import Counter
 import argparse
 import uuid
-import hashlib
+import math
+import numpy as np
+import orjson
+import xxhash
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Install uvloop for better async performance
+asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 @dataclass
 class TestConfig:
     """Configuration for load testing"""
@@ -28,18 +33,6 @@ class TestConfig:
     request_rate: int = 1000  # requests per second
     output_file: str = "test_results.json"
     
-@dataclass
-class RequestResult:
-    """Result of a single request"""
-    success: bool
-    status_code: int
-    response_time: float
-    tokens_sent: int
-    tokens_received: int
-    api_key: str
-    timestamp: float
-    error_message: Optional[str] = None
-
 class MockRequestGenerator:
     """Generates realistic mock OpenAI API requests"""
     
@@ -56,31 +49,49 @@ class MockRequestGenerator:
             "What is the difference between async and sync programming?",
             "How does load balancing work in microservices?"
         ]
+        self._prompt_cache: Dict[Tuple[str, int], str] = {}
+        self._tokens_for_key: Dict[str, int] = {}
         
-    def generate_request(self, api_key: str) -> Dict[str, Any]:
-        """Generate a mock OpenAI chat completion request"""
-        prompt = random.choice(self.prompts)
-        
-        # Generate deterministic request based on API key for consistent testing
-        hash_obj = hashlib.md5(api_key.encode())
-        hash_hex = hash_obj.hexdigest()
-        
-        # Generate input tokens (100-1000)
-        input_tokens = 100 + (int(hash_hex[:4], 16) % 900)
+    def _input_tokens(self, api_key: str) -> int:
+        """Deterministic input token count for an API key, computed once per key"""
+        input_tokens = self._tokens_for_key.get(api_key)
+        if input_tokens is None:
+            # Generate deterministic request based on API key for consistent
+            # testing, using a fast non-cryptographic hash
+            hash_int = xxhash.xxh64_intdigest(api_key.encode()) & 0xFFFF
+            
+            # Generate input tokens (100-1000)
+            input_tokens = 100 + (hash_int % 900)
+            self._tokens_for_key[api_key] = input_tokens
+        return input_tokens
         
-        # Create messages with appropriate length
-        words_needed = input_tokens * 0.75  # Rough approximation
-        extended_prompt = prompt
-        while len(extended_prompt.split()) < words_needed:
-            extended_prompt += f" {prompt}"
+    def generate_request(
+        self,
+        api_key: str,
+        prompt_idx: int,
+        max_tokens: int,
+        temperature: float
+    ) -> Dict[str, Any]:
+        """Generate a mock OpenAI chat completion request from pre-drawn parameters"""
+        # The prompt text only depends on the API key and prompt, so build
+        # each combination once
+        extended_prompt = self._prompt_cache.get((api_key, prompt_idx))
+        if extended_prompt is None:
+            prompt = self.prompts[prompt_idx]
+            
+            # Create messages with appropriate length
+            words_needed = self._input_tokens(api_key) * 0.75  # Rough approximation
+            repeat_count = max(1, math.ceil(words_needed / len(prompt.split())))
+            extended_prompt = " ".join([prompt] * repeat_count)
+            self._prompt_cache[(api_key, prompt_idx)] = extended_prompt
             
         return {
             "model": "gpt-3.5-turbo",
             "messages": [
                 {"role": "user", "content": extended_prompt}
             ],
-            "max_tokens": random.randint(50, 500),
-            "temperature": random.uniform(0.1, 1.0)
+            "max_tokens": max_tokens,
+            "temperature": temperature
         }
 
 class HighPerformanceLoadTester:
@@ -88,11 +99,31 @@ class HighPerformanceLoadTester:
     
     def __init__(self, config: TestConfig):
         self.config = config
-        self.results = []
         self.start_time = None
-        self.stats = defaultdict(int)
-        self.response_times = deque(maxlen=10000)
-        self.error_counts = defaultdict(int)
+        
+        # The fields the report aggregates are stored column-wise in
+        # preallocated arrays, one slot per request, instead of one result
+        # object per request
+        capacity = config.duration_seconds * config.request_rate
+        self.num_results = 0
+        self.latencies = np.empty(capacity, dtype=np.float64)
+        self.status_codes = np.empty(capacity, dtype=np.int16)
+        self.successes = np.empty(capacity, dtype=np.bool_)
+        self.key_indices = np.empty(capacity, dtype=np.int32)
+        self.error_messages = [None] * capacity
+        
+        # Per-request details are streamed to NDJSON while the test runs
+        self.details_file = config.output_file + ".ndjson"
+        self._ndjson = None
+        
+        # Draw every request's random parameters upfront in bulk
+        self.request_generator = MockRequestGenerator()
+        rng = np.random.default_rng()
+        self._prompt_indices = rng.integers(0, len(self.request_generator.prompts), capacity).tolist()
+        self._max_tokens = rng.integers(50, 501, capacity).tolist()
+        self._temperatures = rng.uniform(0.1, 1.0, capacity).tolist()
+        self._request_keys = rng.integers(0, len(config.api_keys), capacity).tolist()
+        self._request_nodes = rng.integers(0, len(config.target_nodes), capacity).tolist()
         
     async def run_load_test(self) -> Dict[str, Any]:
         """Run the complete load test"""
@@ -103,34 +134,49 @@ class HighPerformanceLoadTester:
         
         self.start_time = time.time()
         
-        # Create semaphore to control concurrency
-        semaphore = asyncio.Semaphore(self.config.concurrent_requests)
-        
-        # Create all tasks
-        tasks = []
-        request_generator = MockRequestGenerator()
-        
         # Calculate total requests to send
         total_requests = self.config.duration_seconds * self.config.request_rate
         
-        # Create tasks with proper timing
-        for i in range(total_requests):
-            target_time = self.start_time + (i / self.config.request_rate)
-            api_key = random.choice(self.config.api_keys)
-            request_data = request_generator.generate_request(api_key)
+        # Share one session so connections are reused across requests
+        timeout = aiohttp.ClientTimeout(total=30)
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=self.config.concurrent_requests * 2,
+            ttl_dns_cache=300
+        )
+        with open(self.details_file, "wb") as self._ndjson:
+            async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+                # Pace requests at the target rate, keeping at most
+                # concurrent_requests tasks alive instead of creating all upfront
+                pending = set()
+                for i in range(total_requests):
+                    target_time = self.start_time + (i / self.config.request_rate)
+                    current_time = time.time()
+                    if target_time > current_time:
+                        await asyncio.sleep(target_time - current_time)
+                    
+                    if len(pending) >= self.config.concurrent_requests:
+                        _, pending = await asyncio.wait(
+                            pending, return_when=asyncio.FIRST_COMPLETED
+                        )
+                    
+                    key_idx = self._request_keys[i]
+                    request_data = self.request_generator.generate_request(
+                        self.config.api_keys[key_idx],
+                        self._prompt_indices[i],
+                        self._max_tokens[i],
+                        self._temperatures[i]
+                    )
+                    target_url = self.config.target_nodes[self._request_nodes[i]]
+                    pending.add(asyncio.create_task(
+                        self._send_single_request(session, request_data, key_idx, target_url)
+                    ))
             
-            task = asyncio.create_task(
-                self._send_request_at_time(
-                    request_data, api_key, target_time, semaphore
-                )
-            )
-            tasks.append(task)
-        
-        # Wait for all tasks to complete
-        try:
-            await asyncio.gather(*tasks, return_exceptions=True)
-        except Exception as e:
-            logger.error(f"Error during load test: {e}")
+                # Wait for in-flight requests to complete
+                try:
+                    await asyncio.gather(*pending, return_exceptions=True)
+                except Exception as e:
+                    logger.error(f"Error during load test: {e}")
             
         # Generate report
         report = await self._generate_report()
@@ -139,34 +185,19 @@ class HighPerformanceLoadTester:
         with open(self.config.output_file, 'w') as f:
             json.dump(report, f, indent=2)
             
-        logger.info(f"Load test completed. Results saved to {self.config.output_file}")
+        logger.info(f"Load test completed. Results saved to {self.config.output_file}, "
+                    f"per-request details to {self.details_file}")
         return report
         
-    async def _send_request_at_time(
-        self, 
-        request_data: Dict, 
-        api_key: str, 
-        target_time: float, 
-        semaphore: asyncio.Semaphore
-    ):
-        """Send request at the specified time"""
-        # Wait until the target time
-        current_time = time.time()
-        if target_time > current_time:
-            await asyncio.sleep(target_time - current_time)
-            
-        async with semaphore:
-            return await self._send_single_request(request_data, api_key)
-            
     async def _send_single_request(
         self, 
+        session: aiohttp.ClientSession,
         request_data: Dict[str, Any], 
-        api_key: str
-    ) -> RequestResult:
-        """Send a single request and record the result"""
-        
-        # Select random target node
-        target_url = random.choice(self.config.target_nodes)
+        key_idx: int,
+        target_url: str
+    ):
+        """Send a single request to target_url and record the result"""
+        api_key = self.config.api_keys[key_idx]
         
         headers = {
             "Authorization": f"Bearer {api_key}",
@@ -174,94 +205,83 @@ class HighPerformanceLoadTester:
             "User-Agent": "LoadTester/1.0"
         }
         
+        success = False
+        status_code = 0
+        body = orjson.dumps(request_data)
+        tokens_sent = len(body)
+        tokens_received = 0
+        error_message = None
         start_time = time.time()
         
         try:
-            timeout = aiohttp.ClientTimeout(total=30)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(
-                    f"{target_url}/v1/chat/completions",
-                    json=request_data,
-                    headers=headers
-                ) as response:
-                    
-                    response_time = time.time() - start_time
-                    
-                    # Read response
-                    try:
-                        response_data = await response.json()
-                        tokens_sent = len(json.dumps(request_data))
-                        tokens_received = len(json.dumps(response_data))
-                        
-                        result = RequestResult(
-                            success=response.status == 200,
-                            status_code=response.status,
-                            response_time=response_time,
-                            tokens_sent=tokens_sent,
-                            tokens_received=tokens_received,
-                            api_key=api_key,
-                            timestamp=start_time,
-                            error_message=None if response.status == 200 else await response.text()
-                        )
+            async with session.post(
+                f"{target_url}/v1/chat/completions",
+                data=body,
+                headers=headers
+            ) as response:
+                
+                response_time = time.time() - start_time
+                status_code = response.status
+                
+                # Read response
+                try:
+                    raw = await response.read()
+                    # Parse only to reject non-JSON bodies, like response.json() did
+                    orjson.loads(raw)
+                    tokens_received = len(raw)
+                    success = response.status == 200
+                    if not success:
+                        error_message = raw.decode()
                         
-                    except Exception as e:
-                        result = RequestResult(
-                            success=False,
-                            status_code=response.status,
-                            response_time=response_time,
-                            tokens_sent=len(json.dumps(request_data)),
-                            tokens_received=0,
-                            api_key=api_key,
-                            timestamp=start_time,
-                            error_message=str(e)
-                        )
-                    
+                except Exception as e:
+                    error_message = str(e)
+                
         except asyncio.TimeoutError:
-            result = RequestResult(
-                success=False,
-                status_code=0,
-                response_time=time.time() - start_time,
-                tokens_sent=len(json.dumps(request_data)),
-                tokens_received=0,
-                api_key=api_key,
-                timestamp=start_time,
-                error_message="Timeout"
-            )
+            response_time = time.time() - start_time
+            error_message = "Timeout"
             
         except Exception as e:
-            result = RequestResult(
-                success=False,
-                status_code=0,
-                response_time=time.time() - start_time,
-                tokens_sent=len(json.dumps(request_data)),
-                tokens_received=0,
-                api_key=api_key,
-                timestamp=start_time,
-                error_message=str(e)
-            )
+            response_time = time.time() - start_time
+            error_message = str(e)
             
-        self.results.append(result)
-        self.response_times.append(result.response_time)
-        
-        # Update stats
-        if result.success:
-            self.stats['successful_requests'] += 1
-        else:
-            self.stats['failed_requests'] += 1
-            self.error_counts[result.error_message] += 1
+        # Record the result into the next free slot
+        i = self.num_results
+        self.num_results += 1
+        self.latencies[i] = response_time
+        self.status_codes[i] = status_code
+        self.successes[i] = success
+        self.key_indices[i] = key_idx
+        self.error_messages[i] = error_message
+        self._ndjson.write(orjson.dumps({
+            "success": success,
+            "status_code": status_code,
+            "response_time_ms": response_time * 1000,
+            "api_key": api_key[:8] + "...",
+            "timestamp": start_time,
+            "tokens_sent": tokens_sent,
+            "tokens_received": tokens_received,
+            "error": error_message
+        }) + b"\n")
             
-        return result
-        
     async def _generate_report(self) -> Dict[str, Any]:
         """Generate comprehensive test report"""
         test_duration = time.time() - self.start_time
         
-        if not self.results:
+        num_results = self.num_results
+        if not num_results:
             return {"error": "No results collected"}
             
-        # Calculate statistics
-        response_times = [r.response_time for r in self.results]
-        successful_times = [r.response_time for r in self.results if r.success]
+        # Calculate statistics over the filled part of each column
+        response_times = self.latencies[:num_results]
+        status_codes = self.status_codes[:num_results]
+        successes = self.successes[:num_results]
+        key_indices = self.key_indices[:num_results]
+        p95, p99 = np.percentile(response_times, [95, 99])
+        successful_requests = int(np.count_nonzero(successes))
+        failed_requests = num_results - successful_requests
+        error_types = Counter(
+            self.error_messages[i] for i in np.flatnonzero(~successes).tolist()
+        )
         
         report = {
             "test_config": {
@@ -273,55 +293,43 @@ class HighPerformanceLoadTester:
                 "total_expected_requests": self.config.duration_seconds * self.config.request_rate
             },
             "summary": {
-                "total_requests": len(self.results),
-                "successful_requests": self.stats['successful_requests'],
-                "failed_requests": self.stats['failed_requests'],
-                "success_rate": self.stats['successful_requests'] / len(self.results),
+                "total_requests": num_results,
+                "successful_requests": successful_requests,
+                "failed_requests": failed_requests,
+                "success_rate": successful_requests / num_results,
                 "test_duration_seconds": test_duration,
-                "requests_per_second": len(self.results) / test_duration
+                "requests_per_second": num_results / test_duration
             },
             "performance_metrics": {
-                "min_response_time_ms": min(response_times) * 1000,
-                "max_response_time_ms": max(response_times) * 1000,
-                "mean_response_time_ms": statistics.mean(response_times) * 1000,
-                "median_response_time_ms": statistics.median(response_times) * 1000,
-                "p95_response_time_ms": statistics.quantiles(response_times, n=20)[18] * 1000,
-                "p99_response_time_ms": statistics.quantiles(response_times, n=100)[98] * 1000,
-                "std_dev_response_time_ms": statistics.stdev(response_times) * 1000 if len(response_times) > 1 else 0
+                "min_response_time_ms": float(response_times.min()) * 1000,
+                "max_response_time_ms": float(response_times.max()) * 1000,
+                "mean_response_time_ms": float(response_times.mean()) * 1000,
+                "median_response_time_ms": float(np.median(response_times)) * 1000,
+                "p95_response_time_ms": float(p95) * 1000,
+                "p99_response_time_ms": float(p99) * 1000,
+                "std_dev_response_time_ms": float(response_times.std(ddof=1)) * 1000 if len(response_times) > 1 else 0
             },
             "error_analysis": {
-                "total_errors": len([r for r in self.results if not r.success]),
-                "error_types": dict(self.error_counts),
-                "rate_limit_hits": len([r for r in self.results if r.status_code == 429])
+                "total_errors": failed_requests,
+                "error_types": dict(error_types),
+                "rate_limit_hits": int(np.count_nonzero(status_codes == 429))
             },
-            "throughput_by_key": {},
-            "detailed_results": [
-                {
-                    "success": r.success,
-                    "status_code": r.status_code,
-                    "response_time_ms": r.response_time * 1000,
-                    "api_key": r.api_key[:8] + "...",
-                    "timestamp": r.timestamp,
-                    "error": r.error_message
-                }
-                for r in self.results
-            ]
+            "throughput_by_key": {}
         }
         
         # Calculate throughput by API key
-        key_stats = defaultdict(lambda: {'requests': 0, 'success': 0})
-        for result in self.results:
-            key_stats[result.api_key]['requests'] += 1
-            if result.success:
-                key_stats[result.api_key]['success'] += 1
-                
+        num_keys = len(self.config.api_keys)
+        key_requests = np.bincount(key_indices, minlength=num_keys)
+        key_successes = np.bincount(key_indices, weights=successes, minlength=num_keys)
+        
         report["throughput_by_key"] = {
-            k: {
-                'total_requests': v['requests'],
-                'success_rate': v['success'] / v['requests'],
-                'requests_per_second': v['requests'] / test_duration
+            key: {
+                'total_requests': int(key_requests[i]),
+                'success_rate': float(key_successes[i] / key_requests[i]),
+                'requests_per_second': int(key_requests[i]) / test_duration
             }
-            for k, v in key_stats.items()
+            for i, key in enumerate(self.config.api_keys)
+            if key_requests[i]
         }
         
         return report